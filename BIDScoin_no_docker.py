@@ -1,9 +1,11 @@
 import os
 import re
+import fnmatch
+import functools
 import subprocess
 from collections import defaultdict
+from dataclasses import dataclass
 import argparse
-import glob
 import shutil
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
@@ -19,24 +21,156 @@ params = {
     'mrivault_dir': '/data/mrivault/_0_STAGING'
 }
 
+_IMG_SUFFIXES = ('_T1w.nii.gz', '_T2w.nii.gz', '_PDw.nii.gz')
+
+_VER_RE = re.compile(r'(\d+\.\d+\.\d+)')
+
 def get_bidscoin_version(path):
-    if not os.path.exists(path):
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        # missing, unreadable or not under a directory; os.path.exists() was False
         print(f"[INFO] Would check if file exists: {path} (not found)")
         return None
+    return _read_bidscoin_version(os.path.realpath(path), mtime_ns)
+
+@functools.lru_cache(maxsize=None)
+def _read_bidscoin_version(path, mtime_ns):
+    """Scan bidsmap.yaml line by line for the version; cached per (path, mtime)."""
     try:
         with open(path, 'r') as f:
-            content = f.read()
-        for line in content.splitlines():
-            if line.strip().startswith('version:'):
-                version_string = line.split(':', 1)[1].strip()
-                matcher = re.search(r'(\d+\.\d+\.\d+)', version_string)
-                if matcher:
-                    return matcher.group(1)
+            for line in f:
+                if line.lstrip().startswith('version:'):
+                    version_string = line.split(':', 1)[1].strip()
+                    matcher = _VER_RE.search(version_string)
+                    if matcher:
+                        return matcher.group(1)
     except Exception as e:
         print(f"Error reading YAML file: {e}")
     return None
 
-raw_dirs = glob.glob(os.path.join(params['dcm_dir'], '1*_*/1*_*'))
+def iter_raw_dirs(dcm_dir, pattern='1*_*'):
+    """Yield paths of <dcm_dir>/<pattern>/<pattern> directories using os.scandir."""
+    try:
+        with os.scandir(dcm_dir) as outer:
+            for a in outer:
+                if not (fnmatch.fnmatchcase(a.name, pattern) and a.is_dir()):
+                    continue
+                with os.scandir(a.path) as inner:
+                    for b in inner:
+                        if fnmatch.fnmatchcase(b.name, pattern) and b.is_dir():
+                            yield b.path
+    except FileNotFoundError:
+        return
+
+@functools.lru_cache(maxsize=4096)
+def _listdir_cached(path, mtime_ns):
+    with os.scandir(path) as it:
+        return tuple((e.name, e.is_dir()) for e in it)
+
+def list_dir(path):
+    """Return (name, is_dir) pairs for path, cached until the directory changes; () if missing."""
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return ()
+    return _listdir_cached(os.fspath(path), mtime_ns)
+
+def first_entry(path):
+    """Return the name of the first entry in path, or None if it is empty."""
+    entries = list_dir(path)
+    return entries[0][0] if entries else None
+
+def list_sources(src):
+    """Return the paths of all non-hidden entries in src (like glob '*')."""
+    return [os.path.join(src, name) for name, _ in list_dir(src) if not name.startswith('.')]
+
+def _copy_entry(src, dst):
+    """copy2, except that a dangling symlink is recreated as a link (as `cp -r` does)."""
+    if os.path.islink(src) and not os.path.exists(src):
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        os.symlink(os.readlink(src), dst)
+    else:
+        shutil.copy2(src, dst)
+
+def copy_sources(src_files, dest_dir):
+    """
+    Copy files and directories into dest_dir, like `cp -r src... dest_dir`.
+    Valid symlinks are followed so the staged copy is self-contained; dangling
+    ones are copied as links instead of failing the copy.
+    """
+    for src in src_files:
+        target = os.path.join(dest_dir, os.path.basename(src))
+        if os.path.isdir(src):
+            shutil.copytree(src, target, copy_function=_copy_entry, dirs_exist_ok=True)
+        else:
+            _copy_entry(src, target)
+
+def chown_tree(path, uid, gid):
+    """Recursively chown path, like `chown -R uid:gid path`; skipped when not running as root."""
+    if hasattr(os, 'geteuid') and os.geteuid() != 0:
+        print(f"[INFO] Not running as root, skipping chown of {path}")
+        return
+    try:
+        os.chown(path, uid, gid, follow_symlinks=False)
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                os.chown(os.path.join(dirpath, name), uid, gid, follow_symlinks=False)
+    except FileNotFoundError:
+        print(f"[INFO] Nothing to chown, {path} does not exist")
+    except PermissionError as e:
+        print(f"[WARN] chown of {path} failed: {e}")
+
+def find_anat_images(subject_path):
+    """Return T1w/T2w/PDw images in <subject_path>/ses-*/anat."""
+    image_files = []
+    for ses, is_dir in list_dir(subject_path):
+        if not (is_dir and ses.startswith('ses-')):
+            continue
+        anat = os.path.join(subject_path, ses, 'anat')
+        image_files.extend(os.path.join(anat, name) for name, _ in list_dir(anat)
+                           if name.endswith(_IMG_SUFFIXES) and not name.startswith('.'))
+    return image_files
+
+def process_image(faced_dir, img_path):
+    """
+    Back up an anatomical image to faced_dir, then deface it with pydeface.
+    The backup is a hardlink when faced_dir is on the same filesystem (a full
+    copy otherwise). pydeface writes to a temporary file next to the image,
+    which then replaces it atomically, so the image is never missing and a
+    failed run leaves the original untouched. Owner and mode are carried over.
+    """
+    img_path = Path(img_path)
+    filename = img_path.name
+    dest_path = os.path.join(faced_dir, f"faced_{filename}")
+    # hidden name with the same suffix so nibabel keeps the format
+    tmp_path = img_path.with_name(f".defacing_{filename}")
+    print(f"Backing up {filename} to faced directory...")
+    try:
+        os.link(img_path, dest_path)
+    except OSError:
+        shutil.copy2(img_path, dest_path)
+    print(f"File backed up: {dest_path}")
+    print(f"Defacing file: {img_path}")
+    try:
+        subprocess.run(['pydeface', str(img_path), '--outfile', str(tmp_path), '--force'], check=True)
+        # the replacement is a new inode: keep the original's owner and mode
+        st = os.stat(img_path)
+        try:
+            os.chown(tmp_path, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass  # only root can give files away
+        shutil.copymode(img_path, tmp_path)
+        os.replace(tmp_path, img_path)
+        print(f"File defaced: {img_path}")
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"Error defacing {img_path}: {e}")
+        tmp_path.unlink(missing_ok=True)
+        # the original is intact; drop the backup so a rerun does not skip it
+        os.unlink(dest_path)
+
+raw_dirs = list(iter_raw_dirs(params['dcm_dir']))
 
 metas = []
 for path in raw_dirs:
@@ -51,14 +185,14 @@ for path in raw_dirs:
     if version is None:
         print(f"[INFO] No version found for {yaml_path}")
         continue
-    try:
-        ses = os.listdir(path)[0]
-    except IndexError:
+    ses = first_entry(path)
+    if ses is None:
         print(f"[INFO] No contents in directory: {path}")
         continue
     meta = {'study': study, 'subjnr': subjnr, 'version': version, 'ses': ses}
     metas.append((meta, path))
 
+copy_jobs = []
 for meta, path in metas:
     print(f"\nstudy: {meta['study']}")
     print(f"session: {meta['ses']}")
@@ -72,8 +206,8 @@ for meta, path in metas:
     print(f"[INFO] Would create directory: {rawdata}")
     
     src = os.path.join(path, meta['ses'])
-    src_files = glob.glob(os.path.join(src, "*"))
-    copy_cmd = ["cp", "-r"] + src_files + [sourcedata_ses]
+    src_files = list_sources(src)
+    copy_jobs.append((sourcedata_ses, rawdata, src_files))
     print(f"cp -r {params['dcm_dir']}/*/{os.path.basename(path)}/{meta['ses']}/* {sourcedata_ses}")
 
 # group by study_subjnr
@@ -83,27 +217,49 @@ for meta_file in metas:
     key = f"{meta['study']}_{meta['subjnr']}"
     grouped[key].append(meta_file)
 
-for key, group_data in grouped.items():
-    combined_meta = group_data[0][0].copy()
-    combined_meta['sessions'] = list(set(m[0]['ses'] for m in group_data))
-    
-    print(f"\nGrouped: subject={combined_meta['subjnr']}, sessions={', '.join(combined_meta['sessions'])}")
-    print(f"Local environment: {combined_meta['version']}")
-    print(f"Host directory: {os.path.join(params['bds_dir'], combined_meta['study'])}")
-    print(f"subject to process: sub-{combined_meta['study']}_{combined_meta['subjnr']}")
-    
-    environments_dir = os.path.join(params['bds_dir'], '_ENVIRONMENTS')
-    env_dir = os.path.join(environments_dir, 'bidscoin_v' + combined_meta['version'])
+@dataclass(slots=True)
+class Job:
+    """All paths and commands needed to process one subject (all its sessions)."""
+    study: str
+    subjnr: str
+    version: str
+    sessions: list
+    activate_path: str
+    sourcedata: str
+    rawdata: str
+    sub_label: str
+    sub_dir: str
+    cmd: str
+
+def plan_job(group_data):
+    meta = group_data[0][0]
+    env_dir = os.path.join(params['bds_dir'], '_ENVIRONMENTS', 'bidscoin_v' + meta['version'])
     activate_path = os.path.join(env_dir, 'env', 'bin', 'activate')
-    
-    sourcedata = os.path.join(params['bds_dir'], combined_meta['study'], 'sourcedata')
-    rawdata = os.path.join(params['bds_dir'], combined_meta['study'], 'rawdata')
-    sub_label = f"sub-{combined_meta['study']}_{combined_meta['subjnr']}"
-    sub_dir = f"sub-{combined_meta['study']}{combined_meta['subjnr']}"
-    
-    cmd = f"source {activate_path} && bidscoiner {sourcedata} {rawdata} -p {sub_label}"
-    print(f"[INFO] Would execute: {cmd}")
-    print(f"[INFO] Would execute chown: chown -R 1002:1004 {os.path.join(rawdata, sub_dir)}")
+    sourcedata = os.path.join(params['bds_dir'], meta['study'], 'sourcedata')
+    rawdata = os.path.join(params['bds_dir'], meta['study'], 'rawdata')
+    sub_label = f"sub-{meta['study']}_{meta['subjnr']}"
+    return Job(
+        study=meta['study'],
+        subjnr=meta['subjnr'],
+        version=meta['version'],
+        sessions=sorted({meta['ses'] for meta, _ in group_data}),
+        activate_path=activate_path,
+        sourcedata=sourcedata,
+        rawdata=rawdata,
+        sub_label=sub_label,
+        sub_dir=f"sub-{meta['study']}{meta['subjnr']}",
+        cmd=f"source {activate_path} && bidscoiner {sourcedata} {rawdata} -p {sub_label}",
+    )
+
+jobs = [plan_job(group_data) for group_data in grouped.values()]
+
+for job in jobs:
+    print(f"\nGrouped: subject={job.subjnr}, sessions={', '.join(job.sessions)}")
+    print(f"Local environment: {job.version}")
+    print(f"Host directory: {os.path.join(params['bds_dir'], job.study)}")
+    print(f"subject to process: {job.sub_label}")
+    print(f"[INFO] Would execute: {job.cmd}")
+    print(f"[INFO] Would execute chown: chown -R 1002:1004 {os.path.join(job.rawdata, job.sub_dir)}")
 
 
 if not args.dry_run:
@@ -112,40 +268,31 @@ if not args.dry_run:
         print("Operation cancelled by user.")
         exit()
 
-for meta, path in metas:
-    sourcedata_ses = os.path.join(params['bds_dir'], meta['study'], 'sourcedata', f"sub-{meta['study']}_{meta['subjnr']}", meta['ses'])
-    rawdata = os.path.join(params['bds_dir'], meta['study'], 'rawdata')
-    
-    if not args.dry_run:
+if not args.dry_run:
+    for sourcedata_ses, rawdata, _ in copy_jobs:
         os.makedirs(sourcedata_ses, exist_ok=True)
         os.makedirs(rawdata, exist_ok=True)
-    
-    src = os.path.join(path, meta['ses'])
-    src_files = glob.glob(os.path.join(src, "*"))
-    copy_cmd = ["cp", "-r"] + src_files + [sourcedata_ses]
-    if not args.dry_run:
-        subprocess.run(copy_cmd)
 
-for key, group_data in grouped.items():
-    combined_meta = group_data[0][0].copy()
-    environments_dir = os.path.join(params['bds_dir'], '_ENVIRONMENTS')
-    env_dir = os.path.join(environments_dir, 'bidscoin_v' + combined_meta['version'])
-    activate_path = os.path.join(env_dir, 'env', 'bin', 'activate')
-    
-    sourcedata = os.path.join(params['bds_dir'], combined_meta['study'], 'sourcedata')
-    rawdata = os.path.join(params['bds_dir'], combined_meta['study'], 'rawdata')
-    sub_label = f"sub-{combined_meta['study']}_{combined_meta['subjnr']}"
-    sub_dir = f"sub-{combined_meta['study']}{combined_meta['subjnr']}"
-    
-    cmd = f"source {activate_path} && bidscoiner {sourcedata} {rawdata} -p {sub_label}"
+# stage all sessions concurrently; copying is I/O-bound and independent per session
+if not args.dry_run and copy_jobs:
+    with ThreadPoolExecutor(max_workers=min(8, len(copy_jobs))) as executor:
+        futures = [(sourcedata_ses, executor.submit(copy_sources, src_files, sourcedata_ses))
+                   for sourcedata_ses, _, src_files in copy_jobs]
+        # a failed copy only affects its own session, as with the former `cp -r`
+        for sourcedata_ses, future in futures:
+            try:
+                future.result()
+            except OSError as e:
+                print(f"[ERROR] Copying sources to {sourcedata_ses} failed: {e}")
+
+for job in jobs:
     if not args.dry_run:
-        subprocess.run(cmd, shell=True)
-        chown_cmd = ["chown", "-R", "1002:1004", os.path.join(rawdata, sub_dir)]
-        subprocess.run(chown_cmd)
+        subprocess.run(job.cmd, shell=True)
+        chown_tree(os.path.join(job.rawdata, job.sub_dir), 1002, 1004)
 
 # JSON Adjustment Section
 print("\nJSON adjustment starts now")
-unique_studies = set(combined_meta['study'] for key, group_data in grouped.items() for combined_meta in [group_data[0][0]])
+unique_studies = {job.study for job in jobs}
 
 for study in unique_studies:
     rawdata_path = os.path.join(params['bds_dir'], study, 'rawdata')
@@ -179,22 +326,20 @@ for study in unique_studies:
 
 # Defacing section
 print("Defacing starts now")
-for key, group_data in grouped.items():
-    combined_meta = group_data[0][0].copy()
-    combined_meta['sessions'] = list(set(m[0]['ses'] for m in group_data))
-    print(f" - sub-{combined_meta['study']}{combined_meta['subjnr']} (sessions: {', '.join(combined_meta['sessions'])})")
+for job in jobs:
+    print(f" - {job.sub_dir} (sessions: {', '.join(job.sessions)})")
 
-    rawdata_path = os.path.join(params['bds_dir'], meta['study']) + '/'
-    faced_dir = os.path.join(params['bds_dir'], meta['study'], 'sourcedata/faced')
+    rawdata_path = os.path.join(params['bds_dir'], job.study) + '/'
+    faced_dir = os.path.join(params['bds_dir'], job.study, 'sourcedata/bidsonym/faced')
 
     print("--- Deface Process Variables ---")
-    print(f"Study: {meta['study']}")
-    print(f"Sessions: {', '.join(combined_meta['sessions'])}")
-    print(f"Subject Number: {meta['subjnr']}")
-    print(f"Version: {meta['version']}")
+    print(f"Study: {job.study}")
+    print(f"Sessions: {', '.join(job.sessions)}")
+    print(f"Subject Number: {job.subjnr}")
+    print(f"Version: {job.version}")
     print(f"Raw Data Path: {rawdata_path}")
     print(f"BIDS Directory: {params['bds_dir']}")
-    print(f"Full Subject Path: {rawdata_path}rawdata/sub-{meta['study']}{meta['subjnr']}")
+    print(f"Full Subject Path: {os.path.join(job.rawdata, job.sub_dir)}")
     print(f"Faced Directory: {faced_dir}")
     print("--------------------------------")
 
@@ -205,38 +350,28 @@ else:
     if response != 'y':
         print("Defacing cancelled by user.")
     else:
-        for key, group_data in grouped.items():
-            meta = group_data[0][0]
-            rawdata_path = os.path.join(params['bds_dir'], meta['study']) + '/'
-            faced_dir = os.path.join(params['bds_dir'], meta['study'], 'sourcedata/bidsonym/faced')
+        all_images = []
+        for job in jobs:
+            faced_dir = os.path.join(params['bds_dir'], job.study, 'sourcedata/bidsonym/faced')
 
             print("Creating faced directory...")
             os.makedirs(faced_dir, exist_ok=True)
             print("Faced directory created.")
 
-            def process_image(img_path):
-                img_path = Path(img_path)
-                filename = img_path.name
-                print(f"Copying {filename} to faced directory...")
-                dest_path = os.path.join(faced_dir, f"faced_{filename}")
-                shutil.copy(img_path, dest_path)
-                print(f"File copied: {dest_path}")
-                print(f"Defacing file: {img_path}")
-                try:
-                    subprocess.run(['pydeface', str(img_path), '--outfile', str(img_path), '--force'], check=True)
-                    print(f"File defaced: {img_path}")
-                except subprocess.CalledProcessError as e:
-                    print(f"Error defacing {img_path}: {e}")
-
-            subject_path = os.path.join(rawdata_path, 'rawdata', f"sub-{meta['study']}{meta['subjnr']}")
-            image_patterns = ['*_T1w.nii.gz', '*_T2w.nii.gz', '*_PDw.nii.gz']
-            image_files = []
-            print("Finding and processing T1w, T2w, and PDw images...")
-            for pattern in image_patterns:
-                p = glob.glob(os.path.join(subject_path, combined_meta['ses'], 'anat', pattern))
-                image_files.extend(p)
-
-            with ThreadPoolExecutor(max_workers=5) as executor:
-                executor.map(process_image, image_files)
-
-            print(f"Copying and defacing completed for subject {meta['study']}{meta['subjnr']}")
+            subject_path = os.path.join(job.rawdata, job.sub_dir)
+            print(f"Finding T1w, T2w, and PDw images for subject {job.study}{job.subjnr}...")
+            image_files = find_anat_images(subject_path)
+
+            for img in image_files:
+                dest_path = os.path.join(faced_dir, f"faced_{os.path.basename(img)}")
+                if os.path.exists(dest_path):
+                    print(f"[INFO] Already defaced (backup exists): {img}, skipping.")
+                else:
+                    all_images.append((faced_dir, img))
+
+        # Deface all subjects' images in one pool so cores stay busy across subject boundaries
+        if all_images:
+            print(f"Defacing {len(all_images)} images...")
+            with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+                list(executor.map(process_image, *zip(*all_images)))
+        print("Copying and defacing completed for all subjects")
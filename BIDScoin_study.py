@@ -2,13 +2,16 @@
 
 import os
 import re
+import functools
 import subprocess
 import argparse
-import glob
 import shutil
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+_VER_RE = re.compile(r"(\d+\.\d+\.\d+)")
+_IMG_SUFFIXES = ('_T1w.nii.gz', '_T2w.nii.gz', '_PDw.nii.gz')
+
 
 def get_bidscoin_version(yaml_path):
     """Extract bidscoin version from bidsmap.yaml."""
@@ -20,7 +23,7 @@ def get_bidscoin_version(yaml_path):
             for line in f:
                 if line.strip().startswith("version:"):
                     version_str = line.split(":", 1)[1].strip()
-                    match = re.search(r"(\d+\.\d+\.\d+)", version_str)
+                    match = _VER_RE.search(version_str)
                     if match:
                         return match.group(1)
         print(f"[WARN] No version found in {yaml_path}")
@@ -30,6 +33,71 @@ def get_bidscoin_version(yaml_path):
         return None
 
 
+@functools.lru_cache(maxsize=4096)
+def _listdir_cached(path, mtime_ns):
+    with os.scandir(path) as it:
+        return tuple((e.name, e.is_dir()) for e in it)
+
+
+def list_dir(path):
+    """Return (name, is_dir) pairs for path, cached until the directory changes; () if missing."""
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return ()
+    return _listdir_cached(os.fspath(path), mtime_ns)
+
+
+def find_anat_images(subject_path):
+    """Return T1w/T2w/PDw images in <subject_path>/ses-*/anat."""
+    image_files = []
+    for ses, is_dir in list_dir(subject_path):
+        if not (is_dir and ses.startswith('ses-')):
+            continue
+        anat = os.path.join(subject_path, ses, 'anat')
+        image_files.extend(os.path.join(anat, name) for name, _ in list_dir(anat)
+                           if name.endswith(_IMG_SUFFIXES) and not name.startswith('.'))
+    return image_files
+
+
+def process_image(faced_dir, img_path):
+    """
+    Back up an anatomical image to faced_dir, then deface it with pydeface.
+    The backup is a hardlink when faced_dir is on the same filesystem (a full
+    copy otherwise). pydeface writes to a temporary file next to the image,
+    which then replaces it atomically, so the image is never missing and a
+    failed run leaves the original untouched. Owner and mode are carried over.
+    """
+    img_path = Path(img_path)
+    filename = img_path.name
+    dest_path = os.path.join(faced_dir, f"faced_{filename}")
+    # hidden name with the same suffix so nibabel keeps the format
+    tmp_path = img_path.with_name(f".defacing_{filename}")
+    print(f"Backing up {filename} to faced directory...")
+    try:
+        os.link(img_path, dest_path)
+    except OSError:
+        shutil.copy2(img_path, dest_path)
+    print(f"File backed up: {dest_path}")
+    print(f"Defacing file: {img_path}")
+    try:
+        subprocess.run(['pydeface', str(img_path), '--outfile', str(tmp_path), '--force'], check=True)
+        # the replacement is a new inode: keep the original's owner and mode
+        st = os.stat(img_path)
+        try:
+            os.chown(tmp_path, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass  # only root can give files away
+        shutil.copymode(img_path, tmp_path)
+        os.replace(tmp_path, img_path)
+        print(f"File defaced: {img_path}")
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"Error defacing {img_path}: {e}")
+        tmp_path.unlink(missing_ok=True)
+        # the original is intact; drop the backup so a rerun does not skip it
+        os.unlink(dest_path)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Run bidscoiner on a single BIDS study using correct environment and deface anatomical images."
@@ -91,7 +159,8 @@ def main():
     # Defacing part starts here
     study_name = study_dir.name
     faced_dir = str(sourcedata / "bidsonym" / "faced")
-    subject_dirs = glob.glob(str(rawdata / "sub-*"))
+    subject_dirs = [str(rawdata / name) for name, is_dir in list_dir(rawdata)
+                    if is_dir and name.startswith('sub-')]
 
     metas = []
     for subj_dir in subject_dirs:
@@ -109,7 +178,7 @@ def main():
             print(f"[INFO] Skipping subject {subj_name} (study {study} does not match {study_name})")
             continue
 
-        sessions = [os.path.basename(s) for s in glob.glob(os.path.join(subj_dir, 'ses-*'))]
+        sessions = [name for name, is_dir in list_dir(subj_dir) if is_dir and name.startswith('ses-')]
         if not sessions:
             print(f"[INFO] No sessions found for {subj_name}")
             continue
@@ -140,35 +209,14 @@ def main():
     else:
         print("[INFO] Would create faced directory.")
 
-    def process_image(img_path):
-        img_path = Path(img_path)
-        filename = img_path.name
-        dest_path = os.path.join(faced_dir, f"faced_{filename}")
-        if os.path.exists(dest_path):
-            print(f"[INFO] Already defaced (backup exists): {img_path}, skipping.")
-            return
-        print(f"Copying {filename} to faced directory...")
-        if not args.dry_run:
-            shutil.copy(img_path, dest_path)
-        print(f"File copied: {dest_path}")
-        print(f"Defacing file: {img_path}")
-        if not args.dry_run:
-            try:
-                subprocess.run(['pydeface', str(img_path), '--outfile', str(img_path), '--force'], check=True)
-                print(f"File defaced: {img_path}")
-            except subprocess.CalledProcessError as e:
-                print(f"Error defacing {img_path}: {e}")
-
+    all_images = []
     for meta in metas:
         print(f"Subject Number: {meta['subjnr']}")
         print(f"Sessions: {', '.join(meta['sessions'])}")
 
         subject_path = str(rawdata / f"sub-{meta['study']}{meta['subjnr']}")
-        image_patterns = ['*_T1w.nii.gz', '*_T2w.nii.gz', '*_PDw.nii.gz']
-        image_files = []
         print("Finding and processing T1w, T2w, and PDw images...")
-        for pattern in image_patterns:
-            image_files.extend(glob.glob(os.path.join(subject_path, 'ses-*', 'anat', pattern)))
+        image_files = find_anat_images(subject_path)
 
         if not image_files:
             print(f"[INFO] No anatomical images found for sub-{meta['study']}{meta['subjnr']}")
@@ -176,17 +224,21 @@ def main():
 
         if args.dry_run:
             print(f"[INFO] Would process {len(image_files)} images for sub-{meta['study']}{meta['subjnr']}")
-            for img in image_files:
-                dest_path = os.path.join(faced_dir, f"faced_{os.path.basename(img)}")
-                if os.path.exists(dest_path):
-                    print(f"[INFO] Already defaced: {img}")
-                else:
-                    print(f"[INFO] Would deface: {img}")
-        else:
-            with ThreadPoolExecutor(max_workers=5) as executor:
-                executor.map(process_image, image_files)
-
-        print(f"Copying and defacing completed for subject {meta['study']}{meta['subjnr']}\n")
+        for img in image_files:
+            dest_path = os.path.join(faced_dir, f"faced_{os.path.basename(img)}")
+            if os.path.exists(dest_path):
+                print(f"[INFO] Already defaced (backup exists): {img}, skipping.")
+            elif args.dry_run:
+                print(f"[INFO] Would deface: {img}")
+            else:
+                all_images.append(img)
+
+    # Deface all subjects' images in one pool so cores stay busy across subject boundaries
+    if all_images:
+        print(f"Defacing {len(all_images)} images...")
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            list(executor.map(process_image, [faced_dir] * len(all_images), all_images))
+        print("Copying and defacing completed for all subjects\n")
 
 
 if __name__ == "__main__":
@@ -5,7 +5,10 @@ Removes MTIME, FNAME, and FHCRC fields from GZIP headers to ensure BIDS validati
 """
 
 from pathlib import Path
-import os, sys, struct, argparse
+from concurrent.futures import ThreadPoolExecutor
+import os, sys, json, shutil, argparse
+
+_GZ_MAGIC = b"\x1f\x8b"
 
 # GZIP Flags
 FHCRC    = 0x02
@@ -13,14 +16,38 @@ FEXTRA   = 0x04
 FNAME    = 0x08
 FCOMMENT = 0x10
 
+COPY_BUF = 8 * 1024 * 1024
+CSTRING_BLOCK = 512
+O_NOATIME = getattr(os, "O_NOATIME", 0)
+
+# Sidecar cache of files already known to be clean (see --cache)
+CACHE_FILE = ".gz_clean_cache.json"
+
+def _skip_cstring(f, start, field):
+    """
+    Find the end of a zero-terminated header field starting at `start`.
+    Reads in blocks, leaves f positioned after the terminator and returns that offset.
+    """
+    pos = start
+    while True:
+        buf = f.read(CSTRING_BLOCK)
+        if not buf:
+            raise ValueError(f"Truncated {field}")
+        nul = buf.find(b"\x00")
+        if nul != -1:
+            end = pos + nul + 1
+            f.seek(end)
+            return end
+        pos += len(buf)
+
 def parse_gzip_header(f):
     """Parse GZIP header and return metadata and offsets."""
     start = f.tell()
     h = f.read(10)
-    if len(h) < 10 or h[:2] != b"\x1f\x8b" or h[2] != 0x08:
+    if len(h) < 10 or h[:2] != _GZ_MAGIC or h[2] != 0x08:
         raise ValueError("Not a gzip member")
     flg = h[3]
-    mtime = struct.unpack("<I", h[4:8])[0]
+    mtime = int.from_bytes(h[4:8], "little")
     idx = start + 10
 
     extra_len_off = None
@@ -35,33 +62,19 @@ def parse_gzip_header(f):
         raw = f.read(2); idx += 2
         if len(raw) < 2:
             raise ValueError("Truncated EXTRA length")
-        xlen = struct.unpack("<H", raw)[0]
+        xlen = int.from_bytes(raw, "little")
         f.seek(xlen, os.SEEK_CUR); idx += xlen
         extra_end = idx
 
     # FNAME (C-String)
     if flg & FNAME:
         fname_start = idx
-        while True:
-            b = f.read(1)
-            if not b:
-                raise ValueError("Truncated FNAME")
-            idx += 1
-            if b == b"\x00":
-                fname_end = idx
-                break
+        idx = fname_end = _skip_cstring(f, idx, "FNAME")
 
     # FCOMMENT (C-String)
     if flg & FCOMMENT:
         fcomment_start = idx
-        while True:
-            b = f.read(1)
-            if not b:
-                raise ValueError("Truncated FCOMMENT")
-            idx += 1
-            if b == b"\x00":
-                fcomment_end = idx
-                break
+        idx = fcomment_end = _skip_cstring(f, idx, "FCOMMENT")
 
     # FHCRC (2 Bytes)
     if flg & FHCRC:
@@ -82,14 +95,37 @@ def parse_gzip_header(f):
         'payload_start': payload_start
     })
 
-def needs_cleaning(path: Path):
-    """Check if a GZIP file needs header cleaning."""
-    with open(path, "rb") as f:
-        h, flg, mtime, _ = parse_gzip_header(f)
-    need_mtime = (mtime != 0)
-    need_fname = bool(flg & FNAME)
-    need_fhcrc = bool(flg & FHCRC)
-    return need_mtime, need_fname, need_fhcrc, flg, mtime
+def read_fixed_header(path):
+    """
+    Read the first 10 bytes of a file with a raw os.open/os.pread, avoiding
+    the buffered file object. O_NOATIME is used where permitted.
+    """
+    if not hasattr(os, "pread"):
+        with open(path, "rb") as f:
+            return f.read(10)
+    try:
+        fd = os.open(path, os.O_RDONLY | O_NOATIME)
+    except PermissionError:
+        # O_NOATIME is only allowed for the file owner
+        if not O_NOATIME:
+            raise
+        fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.pread(fd, 10, 0)
+    finally:
+        os.close(fd)
+
+def quick_needs_cleaning(path):
+    """
+    Fast check using only the fixed 10-byte GZIP header.
+    Returns (needs_cleaning, flg, mtime) without parsing optional fields.
+    """
+    h = read_fixed_header(path)
+    if len(h) < 10 or h[:2] != _GZ_MAGIC or h[2] != 0x08:
+        raise ValueError("Not a gzip member")
+    flg = h[3]
+    mtime = int.from_bytes(h[4:8], "little")
+    return (mtime != 0) or bool(flg & FNAME), flg, mtime
 
 def rewrite_header_only(inf, outf, meta):
     """
@@ -133,16 +169,76 @@ def rewrite_header_only(inf, outf, meta):
         payload_from = off['fhcrc_off'] + 2
 
     # Copy rest of file (compressed data + trailer + additional members)
-    inf.seek(payload_from, os.SEEK_SET)
-    BUF = 1024 * 1024
-    while True:
-        chunk = inf.read(BUF)
-        if not chunk:
-            break
-        outf.write(chunk)
+    copy_body(inf, outf, payload_from)
+
+def _kernel_copy(copy, inf, outf, offset, count):
+    """Run an in-kernel copy primitive until count bytes are copied; return bytes copied."""
+    done = 0
+    try:
+        while done < count:
+            n = copy(outf.fileno(), inf.fileno(), offset + done, count - done)
+            if n == 0:
+                break
+            done += n
+    except OSError:
+        # not supported for this platform/filesystem combination
+        pass
+    return done
+
+def _copy_file_range(out_fd, in_fd, offset, count):
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+def copy_body(inf, outf, offset):
+    """
+    Copy everything from `offset` to EOF of inf onto the end of outf.
+    Tries os.copy_file_range (which may reflink or copy inside the page cache),
+    then os.sendfile, and falls back to shutil.copyfileobj with a large buffer.
+    """
+    remaining = os.fstat(inf.fileno()).st_size - offset
+    if remaining <= 0:
+        return
+    outf.flush()
+    for copy in KERNEL_COPIES:
+        done = _kernel_copy(copy, inf, outf, offset, remaining)
+        offset += done
+        remaining -= done
+        if remaining == 0:
+            return
+        outf.seek(0, os.SEEK_END)
+    inf.seek(offset, os.SEEK_SET)
+    shutil.copyfileobj(inf, outf, COPY_BUF)
+
+# In-kernel copy primitives for copy_body, in order of preference
+KERNEL_COPIES = []
+if hasattr(os, "copy_file_range"):
+    KERNEL_COPIES.append(_copy_file_range)
+if hasattr(os, "sendfile"):
+    KERNEL_COPIES.append(os.sendfile)
 
 def clean_file(path: Path):
-    """Clean a single GZIP file."""
+    """
+    Clean a single GZIP file.
+    If only MTIME has to be zeroed the header length is unchanged, so the
+    4 bytes are patched in place; otherwise the file is rewritten to a
+    temporary file and moved over the original.
+    """
+    # Symlinks (e.g. git-annex) and hardlinks must not be modified in place
+    st = os.lstat(path)
+    if not os.path.islink(path) and st.st_nlink == 1:
+        try:
+            f = open(path, "r+b")
+        except PermissionError:
+            # Read-only file: replacing it only needs a writable directory
+            f = None
+        if f is not None:
+            with f:
+                h = f.read(10)
+                if len(h) == 10 and h[:2] == _GZ_MAGIC and h[2] == 0x08 and not (h[3] & (FNAME | FHCRC)):
+                    if h[4:8] != b"\x00\x00\x00\x00":
+                        f.seek(4)
+                        f.write(b"\x00\x00\x00\x00")
+                    return
+
     with open(path, "rb") as inf:
         meta = parse_gzip_header(inf)
         tmp = path.with_suffix(path.suffix + ".tmp")
@@ -150,59 +246,146 @@ def clean_file(path: Path):
             rewrite_header_only(inf, outf, meta)
         os.replace(tmp, path)
 
-def clean_gzip_headers(directory, dry_run=False, verbose=False):
+def walk_gz(root):
+    """Yield paths (as strings) of all .gz files under root using os.scandir."""
+    stack = [os.fspath(root)]
+    while stack:
+        d = stack.pop()
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        stack.append(e.path)
+                    elif e.name.endswith(".gz"):
+                        yield e.path
+        except OSError:
+            continue
+
+def _stamp(path):
+    """Return the [size, mtime_ns] stamp used as cache key for a file."""
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def load_cache(cache_path):
+    """Load the sidecar cache of known-clean files ({} if missing or invalid)."""
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def save_cache(cache_path, cache):
+    """Atomically write the sidecar cache of known-clean files."""
+    tmp = str(cache_path) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp, cache_path)
+
+def _process_one(path, dry_run=False, cache=None, key=None):
+    """
+    Check and (unless dry_run) clean a single GZIP file.
+    Returns (path, status, issues, error, stamp) where status is one of
+    'cached', 'ok', 'would_clean', 'cleaned', 'check_error' or 'clean_error'
+    and stamp is the file's [size, mtime_ns] once known to be clean.
+    """
+    stamp = None
+    if cache is not None:
+        try:
+            stamp = _stamp(path)
+        except OSError as e:
+            return path, "check_error", None, e, None
+        if cache.get(key) == stamp:
+            return path, "cached", None, None, stamp
+
+    try:
+        needed, flg, mtime = quick_needs_cleaning(path)
+    except Exception as e:
+        return path, "check_error", None, e, None
+
+    if not needed:
+        return path, "ok", None, None, stamp
+
+    issues = []
+    if mtime != 0:
+        issues.append(f"mtime={mtime}")
+    if flg & FNAME:
+        issues.append("filename")
+    if flg & FHCRC:
+        issues.append("crc")
+
+    if dry_run:
+        return path, "would_clean", issues, None, None
+    try:
+        clean_file(path)
+        if cache is not None:
+            stamp = _stamp(path)
+    except Exception as e:
+        return path, "clean_error", issues, e, None
+    return path, "cleaned", issues, None, stamp
+
+def clean_gzip_headers(directory, dry_run=False, verbose=False, jobs=None, use_cache=False):
     """
     Clean GZIP headers in all .gz files under the given directory.
+    Files are processed concurrently by `jobs` worker threads
+    (default: 2 x CPU count); output is printed from the calling thread.
+    With use_cache, files recorded as clean in CACHE_FILE under the
+    directory are skipped while their size and mtime are unchanged.
     Returns (total_files, cleaned_files, errors).
     """
     root = Path(directory)
     if not root.exists():
         raise FileNotFoundError(f"Directory not found: {root}")
 
-    # Find all *.gz files recursively
-    targets = list(root.rglob("*.gz"))
-    if not targets:
-        if verbose:
-            print("🔍 No .gz files found.")
-        return 0, 0, 0
-
     total = changed = errors = 0
-    
+
     if verbose:
-        print(f"🔍 Found {len(targets)} .gz files to check...")
+        print(f"🔍 Checking .gz files under {root}...")
 
-    for p in sorted(targets):
-        total += 1
-        try:
-            need_mtime, need_fname, need_fhcrc, flg, mtime = needs_cleaning(p)
-        except Exception as e:
-            if verbose:
-                print(f"❌ Error checking {p.name}: {e}")
-            errors += 1
-            continue
+    if jobs is None:
+        jobs = (os.cpu_count() or 1) * 2
 
-        if need_mtime or need_fname:
-            issues = []
-            if need_mtime: 
-                issues.append(f"mtime={mtime}")
-            if need_fname: 
-                issues.append("filename")
-            if need_fhcrc: 
-                issues.append("crc")
-            
-            if dry_run:
+    cache_path = root / CACHE_FILE
+    cache = load_cache(cache_path) if use_cache else None
+    new_cache = {}
+
+    def work(p):
+        return _process_one(Path(p), dry_run, cache, os.path.relpath(p, root))
+
+    # Files are submitted as the directory walk yields them, so workers
+    # start before the walk is complete
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as ex:
+        for p, status, issues, err, stamp in ex.map(work, walk_gz(root)):
+            total += 1
+            if stamp is not None:
+                new_cache[os.path.relpath(p, root)] = stamp
+            if status == "check_error":
+                if verbose:
+                    print(f"❌ Error checking {p.name}: {err}")
+                errors += 1
+            elif status == "clean_error":
+                if verbose:
+                    print(f"❌ Error cleaning {p.name}: {err}")
+                errors += 1
+            elif status == "would_clean":
                 if verbose:
                     print(f"🧪 Would clean {p.name} ({', '.join(issues)})")
-            else:
-                try:
-                    clean_file(p)
-                    if verbose:
-                        print(f"✅ Cleaned {p.name} ({', '.join(issues)})")
-                    changed += 1
-                except Exception as e:
-                    if verbose:
-                        print(f"❌ Error cleaning {p.name}: {e}")
-                    errors += 1
+            elif status == "cleaned":
+                if verbose:
+                    print(f"✅ Cleaned {p.name} ({', '.join(issues)})")
+                changed += 1
+
+    if total == 0:
+        if verbose:
+            print("🔍 No .gz files found.")
+        return 0, 0, 0
+
+    if use_cache and not dry_run:
+        try:
+            save_cache(cache_path, new_cache)
+        except OSError as e:
+            if verbose:
+                print(f"⚠️ Could not write cache {cache_path}: {e}")
 
     return total, changed, errors
 
@@ -215,12 +398,15 @@ Examples:
   %(prog)s /path/to/bids/dataset
   %(prog)s --dry-run /path/to/bids/dataset
   %(prog)s --verbose /path/to/bids/dataset
+  %(prog)s --cache /path/to/bids/dataset
         """
     )
     parser.add_argument("directory", help="Path to directory containing .gz files")
     parser.add_argument("--dry-run", action="store_true", help="Show what would be cleaned without making changes")
     parser.add_argument("--verbose", "-v", action="store_true", help="Show detailed progress information")
     parser.add_argument("--quiet", "-q", action="store_true", help="Suppress all output except errors")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="Number of files to process in parallel (default: 2 x CPU count)")
+    parser.add_argument("--cache", action="store_true", help=f"Remember clean files in {CACHE_FILE} and skip them on later runs while unchanged")
     
     args = parser.parse_args()
 
@@ -228,7 +414,7 @@ Examples:
     verbose = args.verbose and not args.quiet
 
     try:
-        total, changed, errors = clean_gzip_headers(args.directory, args.dry_run, verbose)
+        total, changed, errors = clean_gzip_headers(args.directory, args.dry_run, verbose, args.jobs, args.cache)
         
         if not args.quiet:
             if args.dry_run:
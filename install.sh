@@ -23,9 +23,14 @@ uv pip install \
     flask \
     waitress \
     psutil \
+    orjson \
     "flask-socketio"
 
 echo "✅ Environment setup complete!"
 echo "To start the web interface, run:"
 echo "  source .venv/bin/activate"
 echo "  python server.py"
+echo ""
+echo "Optional: for native WebSockets instead of long-polling, run"
+echo "  uv pip install gevent simple-websocket"
+echo "  PRISM2DATALAD_ASYNC_MODE=gevent python server.py"
@@ -2,42 +2,133 @@
 import os
 import sys
 
+_HERE = os.path.dirname(os.path.abspath(__file__))
+VENV_DIR = os.path.join(_HERE, '.venv')
+VENV_PYTHON = os.path.join(VENV_DIR, 'Scripts/python.exe' if os.name == 'nt' else 'bin/python')
+
+def _venv_site_packages():
+    """Return the .venv site-packages directory if it matches this interpreter's version."""
+    if os.name == 'nt':
+        sp = os.path.join(VENV_DIR, 'Lib', 'site-packages')
+    else:
+        sp = os.path.join(VENV_DIR, 'lib', f'python{sys.version_info[0]}.{sys.version_info[1]}', 'site-packages')
+    return sp if os.path.isdir(sp) else None
+
+def activate_venv(site_packages):
+    """Activate .venv in the running interpreter instead of restarting under its python."""
+    import site
+    os.environ['VIRTUAL_ENV'] = VENV_DIR
+    bin_dir = os.path.dirname(VENV_PYTHON)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    # addsitedir appends (and processes .pth files); move the new entries in front
+    # of the system paths, keeping the script directory first
+    before = list(sys.path)
+    site.addsitedir(site_packages)
+    added = [p for p in sys.path if p not in before]
+    sys.path[:] = before[:1] + added + before[1:]
+    sys.prefix = sys.exec_prefix = VENV_DIR
+
 def check_venv():
     """Ensure the script runs within the local .venv virtual environment."""
-    # Check if already in a virtual environment
-    is_venv = hasattr(sys, 'real_prefix') or (hasattr(sys, 'base_prefix') and sys.base_prefix != sys.prefix)
-    if is_venv:
+    # Already in a virtual environment (or the check was explicitly disabled)
+    if sys.prefix != sys.base_prefix or os.environ.get('PRISM2DATALAD_SKIP_VENV_CHECK') == '1':
         return
 
-    # Check for .venv in the current directory
-    venv_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.venv')
-    python_exe = 'Scripts/python.exe' if os.name == 'nt' else 'bin/python'
-    venv_python = os.path.join(venv_dir, python_exe)
-
-    if os.path.exists(venv_python):
-        print(f"🔄 Activating virtual environment: {venv_dir}")
-        os.execv(venv_python, [venv_python] + sys.argv)
+    if os.path.isfile(VENV_PYTHON):
+        print(f"🔄 Activating virtual environment: {VENV_DIR}")
+        site_packages = _venv_site_packages()
+        if site_packages:
+            activate_venv(site_packages)
+            # Only locate the dependencies: importing them here would run before
+            # the gevent monkey-patch below
+            import importlib.util
+            if all(importlib.util.find_spec(m) for m in ('flask', 'flask_socketio', 'waitress', 'psutil')):
+                return
+        # Different Python version or unusable packages: restart under the venv's python
+        os.execv(VENV_PYTHON, [VENV_PYTHON] + sys.argv)
     else:
-        print(f"⚠️ Warning: .venv not found at {venv_dir}. Running with system python.")
+        print(f"⚠️ Warning: .venv not found at {VENV_DIR}. Running with system python.")
 
 # Boot the venv before importing third-party modules
 check_venv()
 
+# Socket.IO transport: 'threading' serves through waitress (HTTP long-polling);
+# 'gevent' serves native WebSockets via gevent (pip install gevent simple-websocket).
+ASYNC_MODE = os.environ.get('PRISM2DATALAD_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'gevent':
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        print("⚠️ Warning: gevent is not installed. Falling back to long-polling (threading mode).")
+        ASYNC_MODE = 'threading'
+elif ASYNC_MODE != 'threading':
+    print(f"⚠️ Warning: unsupported PRISM2DATALAD_ASYNC_MODE '{ASYNC_MODE}'. Using threading mode.")
+    ASYNC_MODE = 'threading'
+
+import atexit
 import subprocess
+import codecs
+import copy
 import json
 import threading
+import time
 import psutil
+import shutil
+import shlex
+from concurrent.futures import ThreadPoolExecutor
 import socket
 import webbrowser
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_socketio import SocketIO, emit
 from waitress import serve
 
+try:
+    import orjson
+except ImportError:
+    # orjson is an optional speedup; fall back to the stdlib json module
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+def json_dumps(obj, pretty=False):
+    """Serialize obj to a JSON string, using orjson when available."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0).decode()
+        except TypeError:
+            # e.g. file names with undecodable bytes (surrogate escapes)
+            pass
+    return json.dumps(obj, indent=2 if pretty else None)
+
+def json_loads(data):
+    """Parse a JSON str or bytes, using orjson when available."""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (via json_dumps/json_loads)."""
+    def dumps(self, obj, **kwargs):
+        return json_dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return json_loads(s)
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = FastJSONProvider(app)
 app.config['SECRET_KEY'] = 'secret!'
-# Use threading mode for SocketIO as it's more standard and avoids eventlet/gevent complexity
-# Waitress doesn't support WebSockets, so we will use long-polling.
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading', logger=False, engineio_logger=False)
+# Threading mode is the default as it's more standard and avoids gevent complexity.
+# Waitress doesn't support WebSockets, so in that mode we use long-polling.
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE, logger=False, engineio_logger=False)
+
+# Shared worker threads for preflight probes and the process output reader,
+# so requests reuse threads instead of creating them per call
+EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='prism2datalad')
+atexit.register(EXECUTOR.shutdown, wait=False, cancel_futures=True)
 
 CONFIG_FILE = 'web_config.json'
 DEFAULT_CONFIG = {
@@ -55,19 +146,61 @@ DEFAULT_CONFIG = {
     }
 }
 
+# In-memory copy of CONFIG_FILE as (mtime_ns, config), refreshed when the file changes
+_CONFIG_CACHE = None
+_CONFIG_LOCK = threading.Lock()
+# Text of CONFIG_FILE as of _CONFIG_CACHE's mtime; lets save_config skip no-op writes
+_saved_config_text = None
+
+def _config_mtime():
+    try:
+        return os.stat(CONFIG_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
 def load_config():
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r') as f:
-            return {**DEFAULT_CONFIG, **json.load(f)}
-    return DEFAULT_CONFIG
+    """Return a private copy of the current config, reading CONFIG_FILE only when it changed."""
+    global _CONFIG_CACHE, _saved_config_text
+    with _CONFIG_LOCK:
+        mtime = _config_mtime()
+        if _CONFIG_CACHE is None or _CONFIG_CACHE[0] != mtime:
+            config = DEFAULT_CONFIG
+            if mtime is not None:
+                with open(CONFIG_FILE, 'rb') as f:
+                    raw = f.read()
+                config = {**DEFAULT_CONFIG, **json_loads(raw)}
+                _saved_config_text = raw.decode('utf-8')
+            _CONFIG_CACHE = (mtime, config)
+        return copy.deepcopy(_CONFIG_CACHE[1])
 
 def save_config(config):
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f, indent=4)
+    """Write config atomically; returns False when the file already holds the same content."""
+    global _CONFIG_CACHE, _saved_config_text
+    text = json_dumps(config, pretty=True)
+    with _CONFIG_LOCK:
+        # No-op only if the file is still the one last read or written here;
+        # a hand edit since then changes its mtime and must be overwritten
+        mtime = _config_mtime()
+        if (text == _saved_config_text and mtime is not None
+                and _CONFIG_CACHE is not None and _CONFIG_CACHE[0] == mtime):
+            return False
+        tmp = CONFIG_FILE + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, CONFIG_FILE)
+        _saved_config_text = text
+        _CONFIG_CACHE = (_config_mtime(), {**DEFAULT_CONFIG, **copy.deepcopy(config)})
+        return True
+
+# Upper bounds for external commands so a hung binary or network
+# cannot block a request thread indefinitely
+PROBE_TIMEOUT = 5
+SSH_CONNECT_TIMEOUT = 5
+SSH_TIMEOUT = 10
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', async_mode=ASYNC_MODE)
 
 @app.route('/api/config', methods=['GET'])
 def get_config():
@@ -76,6 +209,11 @@ def get_config():
 @app.route('/api/config', methods=['POST'])
 def update_config():
     config = request.json
+    if not isinstance(config, dict):
+        return jsonify({"error": "Config must be a JSON object"}), 400
+    unknown = config.keys() - DEFAULT_CONFIG.keys()
+    if unknown:
+        return jsonify({"error": f"Unknown config keys: {', '.join(sorted(unknown))}"}), 400
     save_config(config)
     return jsonify({"status": "success"})
 
@@ -90,17 +228,33 @@ def list_dirs():
             return jsonify({"error": "Path does not exist"}), 404
         
         parent = os.path.dirname(abs_path)
-        items = []
-        for item in sorted(os.listdir(abs_path)):
-            full_path = os.path.join(abs_path, item)
-            if os.path.isdir(full_path):
-                items.append(item)
-        
-        return jsonify({
-            "current_path": abs_path,
-            "parent_path": parent,
-            "directories": items
-        })
+        # Open the directory up front so errors still produce a JSON error response
+        it = os.scandir(abs_path)
+
+        # Stream the listing as it is read instead of building it in memory first;
+        # entries arrive in directory order and are sorted by the client.
+        # DirEntry.is_dir() uses the d_type from readdir, so no stat per entry
+        # (symlinked directories are still followed, as os.path.isdir did)
+        def generate():
+            with it:
+                yield '{"current_path": %s, "parent_path": %s, "directories": [' % (
+                    json_dumps(abs_path), json_dumps(parent))
+                sep = ''
+                try:
+                    for e in it:
+                        if e.is_dir():
+                            yield sep + json_dumps(e.name)
+                            sep = ', '
+                except OSError as e:
+                    # The status line is already sent; end the JSON and report it inline
+                    yield '], "error": %s}' % json_dumps(str(e))
+                    return
+                yield ']}'
+
+        response = Response(generate(), mimetype='application/json')
+        # Release the directory handle even if the body is never iterated
+        response.call_on_close(it.close)
+        return response
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -116,10 +270,14 @@ def create_dir():
         if '@' in path and ':' in path:
             host_part, remote_path = path.split(':', 1)
             # Use ssh to create the directory
-            res = subprocess.run(
-                ["ssh", "-o", "BatchMode=yes", host_part, f"mkdir -p '{remote_path}'"],
-                capture_output=True, text=True
-            )
+            try:
+                res = subprocess.run(
+                    ["ssh", "-o", "BatchMode=yes", "-o", f"ConnectTimeout={SSH_CONNECT_TIMEOUT}",
+                     "--", host_part, f"mkdir -p -- {shlex.quote(remote_path)}"],
+                    capture_output=True, text=True, timeout=SSH_TIMEOUT
+                )
+            except subprocess.TimeoutExpired:
+                return jsonify({"error": f"SSH Error: timed out after {SSH_TIMEOUT}s"}), 504
             if res.returncode != 0:
                 return jsonify({"error": f"SSH Error: {res.stderr}"}), 500
             return jsonify({"status": "success", "path": path})
@@ -130,44 +288,55 @@ def create_dir():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/preflight', methods=['GET'])
-def preflight():
-    checks = {
-        "datalad": False,
-        "git": False,
-        "git_annex": False,
-        "deno": False,
-        "disk_space": "Unknown"
-    }
-    
-    # Check datalad
-    try:
-        subprocess.run(["datalad", "--version"], capture_output=True, check=True)
-        checks["datalad"] = True
-    except: pass
+# Preflight results are cached: tool availability rarely changes while the
+# server runs, and the UI may poll this endpoint
+PREFLIGHT_TOOLS_TTL = 60
+PREFLIGHT_DISK_TTL = 5
+_preflight_cache = {}
+_preflight_lock = threading.Lock()
 
-    # Check git
-    try:
-        subprocess.run(["git", "--version"], capture_output=True, check=True)
-        checks["git"] = True
-    except: pass
+def _cached(key, ttl, compute):
+    """Return compute() for key, reusing a previous result younger than ttl seconds."""
+    with _preflight_lock:
+        hit = _preflight_cache.get(key)
+    if hit and time.monotonic() - hit[0] < ttl:
+        return hit[1]
+    value = compute()
+    with _preflight_lock:
+        _preflight_cache[key] = (time.monotonic(), value)
+    return value
 
-    # Check git-annex
-    try:
-        subprocess.run(["git-annex", "version"], capture_output=True, check=True)
-        checks["git_annex"] = True
-    except: pass
+TOOL_CHECKS = (
+    ("datalad", ["datalad", "--version"]),
+    ("git", ["git", "--version"]),
+    ("git_annex", ["git-annex", "version"]),
+    ("deno", ["deno", "--version"]),
+)
 
-    # Check deno
+def _probe(cmd):
+    """Return True if cmd can be run and exits successfully."""
+    # Missing tools are the common failure; detect them without a fork
+    if shutil.which(cmd[0]) is None:
+        return False
     try:
-        subprocess.run(["deno", "--version"], capture_output=True, check=True)
-        checks["deno"] = True
-    except: pass
+        subprocess.run(cmd, capture_output=True, check=True, timeout=PROBE_TIMEOUT)
+        return True
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return False
 
-    # Disk space
+def _check_tools():
+    # The probes are independent fork+execs, so run them concurrently
+    results = EXECUTOR.map(_probe, [cmd for _, cmd in TOOL_CHECKS])
+    return {name: ok for (name, _), ok in zip(TOOL_CHECKS, results)}
+
+def _disk_space():
     usage = psutil.disk_usage('/')
-    checks["disk_space"] = f"{usage.free // (1024**3)} GB free"
+    return f"{usage.free // (1024**3)} GB free"
 
+@app.route('/api/preflight', methods=['GET'])
+def preflight():
+    checks = dict(_cached("tools", PREFLIGHT_TOOLS_TTL, _check_tools))
+    checks["disk_space"] = _cached("disk_space", PREFLIGHT_DISK_TTL, _disk_space)
     return jsonify(checks)
 
 @app.route('/shutdown', methods=['POST'])
@@ -178,73 +347,172 @@ def shutdown():
     return jsonify(success=True)
 
 active_process = None
+# Serializes the "is a process running?" check with starting a new one
+_process_lock = threading.Lock()
+
+# Batching of subprocess output sent to the browser
+EMIT_INTERVAL = 0.05
+EMIT_MAX_LINES = 32
+EMIT_MAX_BYTES = 8192
+READ_CHUNK = 16384
+# Linux pipes default to 64 KiB; a larger buffer absorbs output bursts so the
+# script does not block on write while the reader is busy emitting
+PIPE_SIZE = 1 << 20
+
+def _grow_pipe(fd):
+    if fcntl is None:
+        return
+    try:
+        fcntl.fcntl(fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), PIPE_SIZE)
+    except OSError:
+        pass  # not Linux, or above /proc/sys/fs/pipe-max-size
+
+# UI flag name -> prism2datalad.sh option
+_FLAG_MAP = (
+    ('skip_bids_validation', '--skip_bids_validation'),
+    ('dry_run', '--dry-run'),
+    ('backup', '--backup'),
+    ('parallel_hash', '--parallel-hash'),
+    ('force_empty', '--force-empty'),
+    ('fasttrack', '--fasttrack'),
+    ('update', '--update'),
+    ('no_gzheader_check', '--no-gzheader-check'),
+)
 
 @socketio.on('start_process')
 def handle_start_process(data):
     global active_process
-    if active_process and active_process.poll() is None:
-        emit('error', {'message': 'A process is already running'})
-        return
-
-    config = data.get('config', load_config())
+    config = data['config'] if 'config' in data else load_config()
     
     cmd = ["bash", "prism2datalad.sh"]
     cmd.extend(["-s", config['src_dir']])
     cmd.extend(["-d", config['dest_root']])
     
     flags = config.get('flags', {})
-    if flags.get('skip_bids_validation'): cmd.append("--skip_bids_validation")
-    if flags.get('dry_run'): cmd.append("--dry-run")
-    if flags.get('backup'): cmd.append("--backup")
-    if flags.get('parallel_hash'): cmd.append("--parallel-hash")
-    if flags.get('force_empty'): cmd.append("--force-empty")
-    if flags.get('fasttrack'): cmd.append("--fasttrack")
-    if flags.get('update'): cmd.append("--update")
-    if flags.get('no_gzheader_check'): cmd.append("--no-gzheader-check")
+    cmd.extend(arg for key, arg in _FLAG_MAP if flags.get(key))
     
-    def run_script():
-        global active_process
-        active_process = subprocess.Popen(
+    with _process_lock:
+        if active_process and active_process.poll() is None:
+            emit('error', {'message': 'A process is already running'})
+            return
+        # Spawn while holding the lock so a concurrent event sees the new process
+        proc = active_process = subprocess.Popen(
             cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
+            bufsize=READ_CHUNK,
+            # Not inert: the script runs datalad and other Python tools whose
+            # output would otherwise be block-buffered into the pipe
             env={**os.environ, "PYTHONUNBUFFERED": "1"}
         )
-        
-        for line in active_process.stdout:
-            socketio.emit('terminal_output', {'data': line})
-        
-        active_process.wait()
-        socketio.emit('process_finished', {'exit_code': active_process.returncode})
+        _grow_pipe(proc.stdout.fileno())
+
+    def run_script():
+        # Coalesce output into one terminal_output event per EMIT_INTERVAL
+        # (or per EMIT_MAX_LINES / EMIT_MAX_BYTES) instead of one per line
+        pending = []
+        pending_bytes = pending_lines = 0
+        pending_lock = threading.Lock()
+        reading_done = threading.Event()
+
+        def flush():
+            nonlocal pending_bytes, pending_lines
+            with pending_lock:
+                if pending:
+                    socketio.emit('terminal_output', {'data': ''.join(pending)})
+                    pending.clear()
+                    pending_bytes = pending_lines = 0
+
+        def flush_periodically():
+            while not reading_done.wait(EMIT_INTERVAL):
+                flush()
 
-    threading.Thread(target=run_script).start()
+        EXECUTOR.submit(flush_periodically)
 
-def is_port_in_use(port):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex(('localhost', port)) == 0
+        def push(text):
+            nonlocal pending_bytes, pending_lines
+            with pending_lock:
+                pending.append(text)
+                pending_bytes += len(text)
+                pending_lines += text.count('\n')
+                return pending_lines >= EMIT_MAX_LINES or pending_bytes >= EMIT_MAX_BYTES
+
+        # Read whatever is available in large chunks and forward complete lines.
+        # '\r' ends a line too (progress bars redraw with it); a trailing partial
+        # line is held back until it ends or grows past EMIT_MAX_BYTES
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        partial = ''
+        while True:
+            chunk = proc.stdout.read1(READ_CHUNK)
+            if not chunk:
+                break
+            text = partial + decoder.decode(chunk)
+            cut = max(text.rfind('\n'), text.rfind('\r')) + 1
+            if len(text) - cut >= EMIT_MAX_BYTES:
+                cut = len(text)
+            partial = text[cut:]
+            if cut and push(text[:cut]):
+                flush()
+
+        tail = partial + decoder.decode(b'', final=True)
+        if tail:
+            push(tail)
+        reading_done.set()
+        flush()
+        proc.wait()
+        socketio.emit('process_finished', {'exit_code': proc.returncode})
+
+    EXECUTOR.submit(run_script)
+
+def bind_free_port(base_port, max_retries):
+    """
+    Bind the first free port in [base_port, base_port + max_retries) and return
+    the socket, falling back to a kernel-assigned port. Handing the bound socket
+    to the server avoids a race between probing a port and listening on it.
+    """
+    for port in list(range(base_port, base_port + max_retries)) + [0]:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # SO_REUSEADDR ignores TIME_WAIT leftovers from a previous run
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(('0.0.0.0', port))
+            return s
+        except OSError:
+            s.close()
+    return None
 
 if __name__ == '__main__':
     base_port = 8080
     max_retries = 10
-    target_port = None
+    sock = bind_free_port(base_port, max_retries)
 
-    for port in range(base_port, base_port + max_retries):
-        if not is_port_in_use(port):
-            target_port = port
-            break
-    
-    if target_port:
+    if sock:
+        target_port = sock.getsockname()[1]
         url = f"http://localhost:{target_port}"
         print(f"🚀 PRISM2DataLad Web Interface: {url}")
-        # Open browser in a separate thread
-        def open_browser():
-            threading.Timer(1.5, lambda: webbrowser.open(url)).start()
-        open_browser()
+        # Open the browser once the server is up; daemon so it never delays exit
+        browser_timer = threading.Timer(1.5, webbrowser.open, args=(url,))
+        browser_timer.daemon = True
+        browser_timer.start()
         
-        # Using waitress for production-ready serving as requested
-        # Note: WebSockets will fall back to long-polling via threading mode
-        serve(app, host='0.0.0.0', port=target_port, _quiet=True)
+        if ASYNC_MODE == 'gevent':
+            # gevent's WSGI server handles the Socket.IO WebSocket upgrade. It is
+            # built directly (as socketio.run would) so it can serve the bound socket
+            from gevent import pywsgi
+            try:
+                from geventwebsocket.handler import WebSocketHandler
+            except ImportError:
+                # WebSocket support then comes from simple-websocket
+                WebSocketHandler = pywsgi.WSGIHandler
+            sock.listen()
+            pywsgi.WSGIServer(sock, app, handler_class=WebSocketHandler, log=None).serve_forever()
+        else:
+            # Using waitress for production-ready serving as requested
+            # Note: WebSockets will fall back to long-polling via threading mode.
+            # Each pending long-poll holds a worker thread, so raise the pool well
+            # above waitress' default of 4; poll() also lifts select()'s fd limit.
+            # gevent mode avoids the thread-per-poll cost entirely.
+            serve(app, sockets=[sock], threads=32, asyncore_use_poll=True,
+                  channel_timeout=120, connection_limit=200, _quiet=True)
     else:
-        print(f"❌ Could not find an available port after {max_retries} attempts.")
+        print("❌ Could not find an available port.")